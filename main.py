@@ -3,46 +3,75 @@ SpeedAF Web API Service
 用于部署在 Zeabur，供 n8n 调用的 RESTful API 服务
 """
 
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 from typing import List, Optional, Dict, Any
+from contextlib import asynccontextmanager
 import time
-from speedaf_api import SpeedAFAPI, OrderBuilder
+from speedaf_api import SpeedAFAPI, build_order
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：每个 worker 启动时创建 SpeedAF 客户端及连接池，关闭时释放"""
+    app.state.speedaf = SpeedAFAPI(
+        app_code=APP_CODE,
+        secret_key=SECRET_KEY,
+        base_url=BASE_URL
+    )
+    await app.state.speedaf.aopen()
+    yield
+    await app.state.speedaf.aclose()
+
+
+async def get_speedaf(request: Request) -> SpeedAFAPI:
+    """依赖注入：获取当前 worker 的 SpeedAF 客户端（async，避免进线程池）"""
+    return request.app.state.speedaf
+
 
 app = FastAPI(
     title="SpeedAF API Service",
     description="SpeedAF 速达非物流 API 服务",
-    version="1.0.0"
-)
-
-# 允许跨域（n8n 可能需要）
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# 初始化 SpeedAF API 客户端（从环境变量读取配置）
+# SpeedAF API 客户端配置（从环境变量读取，客户端在 lifespan 中创建）
 import os
 
 APP_CODE = os.getenv("SPEEDAF_APP_CODE", "11111111")
 SECRET_KEY = os.getenv("SPEEDAF_SECRET_KEY", "uYMGr8eU")
 BASE_URL = os.getenv("SPEEDAF_BASE_URL", "https://uat-api.speedaf.com")
 
-speedaf_api = SpeedAFAPI(
-    app_code=APP_CODE,
-    secret_key=SECRET_KEY,
-    base_url=BASE_URL
-)
+# n8n 为服务端调用，不需要跨域；仅在浏览器访问时通过 ENABLE_CORS=1 开启
+# 开启时必须通过 CORS_ORIGIN 指定允许的来源（逗号分隔）
+if os.getenv("ENABLE_CORS") == "1":
+    cors_origins = [o.strip() for o in os.getenv("CORS_ORIGIN", "").split(",") if o.strip()]
+    if not cors_origins:
+        raise RuntimeError("ENABLE_CORS=1 时必须设置 CORS_ORIGIN")
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=cors_origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
 
 
 # ========== 数据模型定义 ==========
 
+# 请求模型共用配置：忽略多余字段，模型只读
+MODEL_CONFIG = ConfigDict(extra="ignore", populate_by_name=True, frozen=True, defer_build=False)
+
+
 class SenderInfo(BaseModel):
     """发件人信息"""
+    model_config = MODEL_CONFIG
+
     name: str = Field(..., description="发件人姓名")
     mobile: str = Field(..., description="发件人手机")
     address: str = Field(..., description="发件人地址")
@@ -54,6 +83,8 @@ class SenderInfo(BaseModel):
 
 class ReceiverInfo(BaseModel):
     """收件人信息"""
+    model_config = MODEL_CONFIG
+
     name: str = Field(..., description="收件人姓名")
     mobile: str = Field(..., description="收件人手机")
     address: str = Field(..., description="收件人地址")
@@ -65,6 +96,8 @@ class ReceiverInfo(BaseModel):
 
 class ParcelInfo(BaseModel):
     """包裹信息"""
+    model_config = MODEL_CONFIG
+
     weight: float = Field(..., description="重量(KG)")
     volume: Optional[float] = Field(default=None, description="体积")
     length: Optional[int] = Field(default=None, description="长度(CM)")
@@ -75,6 +108,8 @@ class ParcelInfo(BaseModel):
 
 class ItemInfo(BaseModel):
     """商品信息"""
+    model_config = MODEL_CONFIG
+
     goods_name: str = Field(..., description="商品名称")
     goods_qty: int = Field(..., description="商品数量")
     goods_value: float = Field(..., description="商品价值")
@@ -86,6 +121,8 @@ class ItemInfo(BaseModel):
 
 class ServiceOptions(BaseModel):
     """服务选项"""
+    model_config = MODEL_CONFIG
+
     delivery_type: str = Field(default="DE01", description="派送类型")
     pay_method: str = Field(default="PA01", description="支付方式")
     parcel_type: str = Field(default="PT01", description="包裹类型")
@@ -94,6 +131,8 @@ class ServiceOptions(BaseModel):
 
 class CreateOrderRequest(BaseModel):
     """创建订单请求"""
+    model_config = MODEL_CONFIG
+
     custom_order_no: str = Field(..., description="客户订单号")
     customer_code: str = Field(..., description="客户编码")
     sender: SenderInfo = Field(..., description="发件人信息")
@@ -105,11 +144,15 @@ class CreateOrderRequest(BaseModel):
 
 class TrackQueryRequest(BaseModel):
     """轨迹查询请求"""
+    model_config = MODEL_CONFIG
+
     mail_no_list: List[str] = Field(..., description="运单号列表")
 
 
 class CancelOrderRequest(BaseModel):
     """取消订单请求"""
+    model_config = MODEL_CONFIG
+
     customer_code: str = Field(..., description="客户编码")
     bill_code: str = Field(..., description="运单号")
     cancel_reason: str = Field(default="customer cancel", description="取消原因")
@@ -117,6 +160,8 @@ class CancelOrderRequest(BaseModel):
 
 class UpdateOrderRequest(BaseModel):
     """更新订单请求"""
+    model_config = MODEL_CONFIG
+
     bill_code: str = Field(..., description="运单号")
     customer_code: str = Field(..., description="客户编码")
     custom_order_no: Optional[str] = Field(default=None, description="客户订单号")
@@ -127,6 +172,50 @@ class UpdateOrderRequest(BaseModel):
     service: Optional[ServiceOptions] = Field(default=None, description="服务选项")
 
 
+# 创建订单手动解析请求体，需自行在 OpenAPI 文档中登记 CreateOrderRequest 及其嵌套模型
+_create_order_schema = CreateOrderRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+_create_order_defs = _create_order_schema.pop("$defs", {})
+_default_openapi = app.openapi
+
+
+def openapi() -> Dict[str, Any]:
+    """生成 OpenAPI 文档，并补充创建订单引用的嵌套模型"""
+    schema = _default_openapi()
+    components = schema.setdefault("components", {}).setdefault("schemas", {})
+    for name, definition in _create_order_defs.items():
+        components.setdefault(name, definition)
+    return schema
+
+
+app.openapi = openapi
+
+
+# ========== 字段映射 ==========
+
+# 更新订单：请求模型字段 → SpeedAF 字段
+FIELD_MAPS = {
+    "sender": {
+        "name": "sendName",
+        "mobile": "sendMobile",
+        "address": "sendAddress",
+        "country_code": "sendCountryCode"
+    },
+    "receiver": {
+        "name": "acceptName",
+        "mobile": "acceptMobile",
+        "address": "acceptAddress",
+        "country_code": "acceptCountryCode"
+    },
+    "parcel": {
+        "weight": "parcelWeight",
+        "volume": "parcelVolume"
+    },
+    "service": {
+        "remark": "remark"
+    }
+}
+
+
 # ========== API 端点 ==========
 
 @app.get("/")
@@ -146,8 +235,19 @@ async def health_check():
     return {"status": "healthy", "timestamp": int(time.time())}
 
 
-@app.post("/api/order/create", summary="创建订单")
-async def create_order(request: CreateOrderRequest):
+@app.post(
+    "/api/order/create",
+    summary="创建订单",
+    response_class=ORJSONResponse,
+    response_model=None,
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": _create_order_schema}}
+        }
+    }
+)
+async def create_order(request: Request, api: SpeedAFAPI = Depends(get_speedaf)):
     """
     创建物流订单
     
@@ -160,97 +260,51 @@ async def create_order(request: CreateOrderRequest):
     - **service**: 服务选项（可选）
     """
     try:
-        # 使用 OrderBuilder 构建订单
-        builder = (OrderBuilder()
-                   .set_custom_order_no(request.custom_order_no)
-                   .set_customer_code(request.customer_code)
-                   .set_sender(
-                       name=request.sender.name,
-                       mobile=request.sender.mobile,
-                       address=request.sender.address,
-                       country_code=request.sender.country_code,
-                       company_name=request.sender.company_name,
-                       phone=request.sender.phone,
-                       email=request.sender.email
-                   )
-                   .set_receiver(
-                       name=request.receiver.name,
-                       mobile=request.receiver.mobile,
-                       address=request.receiver.address,
-                       country_code=request.receiver.country_code,
-                       company_name=request.receiver.company_name,
-                       phone=request.receiver.phone,
-                       email=request.receiver.email
-                   )
-                   .set_parcel_info(
-                       weight=request.parcel.weight,
-                       volume=request.parcel.volume,
-                       length=request.parcel.length,
-                       width=request.parcel.width,
-                       height=request.parcel.height,
-                       piece=request.parcel.piece
-                   ))
-        
-        # 添加商品
-        for item in request.items:
-            builder.add_item(
-                goods_name=item.goods_name,
-                goods_qty=item.goods_qty,
-                goods_value=item.goods_value,
-                goods_weight=item.goods_weight,
-                goods_name_dialect=item.goods_name_dialect,
-                goods_type=item.goods_type,
-                sku=item.sku
-            )
-        
-        # 设置服务选项
-        if request.service:
-            builder.set_service_options(
-                delivery_type=request.service.delivery_type,
-                pay_method=request.service.pay_method,
-                parcel_type=request.service.parcel_type,
-                remark=request.service.remark
-            )
-        else:
-            builder.set_service_options()
-        
-        order_data = builder.build()
+        order = CreateOrderRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors()]
+        )
+    
+    try:
+        # 一次 model_dump 后由 build_order 直接构建订单字典
+        order_data = build_order(order.model_dump(exclude_none=True))
         
         # 调用 SpeedAF API
-        result = speedaf_api.create_order(order_data)
+        result = await api.create_order(order_data)
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "data": result,
             "message": "订单创建成功"
-        }
+        })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/track/query", summary="查询物流轨迹")
-async def query_track(request: TrackQueryRequest):
+@app.post("/api/track/query", summary="查询物流轨迹", response_class=ORJSONResponse, response_model=None)
+async def query_track(request: TrackQueryRequest, api: SpeedAFAPI = Depends(get_speedaf)):
     """
-    查询物流轨迹
+    查询物流轨迹（30 秒内相同运单号的查询走缓存，响应头 X-Cache 标明 HIT/MISS）
     
     - **mail_no_list**: 运单号列表
     """
     try:
-        result = speedaf_api.query_track(request.mail_no_list)
+        result, hit = await api.query_track_cached(request.mail_no_list)
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "data": result,
             "message": "查询成功"
-        }
+        }, headers={"X-Cache": "HIT" if hit else "MISS"})
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/order/cancel", summary="取消订单")
-async def cancel_order(request: CancelOrderRequest):
+@app.post("/api/order/cancel", summary="取消订单", response_class=ORJSONResponse, response_model=None)
+async def cancel_order(request: CancelOrderRequest, api: SpeedAFAPI = Depends(get_speedaf)):
     """
     取消订单
     
@@ -259,24 +313,24 @@ async def cancel_order(request: CancelOrderRequest):
     - **cancel_reason**: 取消原因
     """
     try:
-        result = speedaf_api.cancel_order(
+        result = await api.cancel_order(
             customer_code=request.customer_code,
             bill_code=request.bill_code,
             cancel_reason=request.cancel_reason
         )
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "data": result,
             "message": "取消请求已提交"
-        }
+        })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/order/update", summary="更新订单")
-async def update_order(request: UpdateOrderRequest):
+@app.post("/api/order/update", summary="更新订单", response_class=ORJSONResponse, response_model=None)
+async def update_order(request: UpdateOrderRequest, api: SpeedAFAPI = Depends(get_speedaf)):
     """
     更新订单信息
     
@@ -285,62 +339,83 @@ async def update_order(request: UpdateOrderRequest):
     - 其他字段为可选，只更新提供的字段
     """
     try:
-        # 构建更新数据
+        # 构建更新数据，按 FIELD_MAPS 只映射提供的字段
+        dump = request.model_dump(exclude_none=True)
         update_data = {
-            "billCode": request.bill_code,
-            "customerCode": request.customer_code
+            "billCode": dump["bill_code"],
+            "customerCode": dump["customer_code"]
         }
         
-        if request.custom_order_no:
-            update_data["customOrderNo"] = request.custom_order_no
-        
-        if request.sender:
-            update_data.update({
-                "sendName": request.sender.name,
-                "sendMobile": request.sender.mobile,
-                "sendAddress": request.sender.address,
-                "sendCountryCode": request.sender.country_code
-            })
+        if dump.get("custom_order_no"):
+            update_data["customOrderNo"] = dump["custom_order_no"]
         
-        if request.receiver:
-            update_data.update({
-                "acceptName": request.receiver.name,
-                "acceptMobile": request.receiver.mobile,
-                "acceptAddress": request.receiver.address,
-                "acceptCountryCode": request.receiver.country_code
-            })
+        for section, fmap in FIELD_MAPS.items():
+            sub = dump.get(section)
+            if sub:
+                update_data.update({fmap[k]: v for k, v in sub.items() if k in fmap})
         
-        if request.parcel:
-            update_data["parcelWeight"] = request.parcel.weight
-            if request.parcel.volume:
-                update_data["parcelVolume"] = request.parcel.volume
+        # 与原逻辑一致：体积为 0 时不更新
+        if not update_data.get("parcelVolume"):
+            update_data.pop("parcelVolume", None)
         
-        if request.items:
+        if dump.get("items"):
             update_data["itemList"] = [
                 {
-                    "goodsName": item.goods_name,
-                    "goodsQTY": item.goods_qty,
-                    "goodsValue": item.goods_value,
-                    "goodsWeight": item.goods_weight
+                    "goodsName": item["goods_name"],
+                    "goodsQTY": item["goods_qty"],
+                    "goodsValue": item["goods_value"],
+                    "goodsWeight": item["goods_weight"]
                 }
-                for item in request.items
+                for item in dump["items"]
             ]
         
-        if request.service:
-            update_data["remark"] = request.service.remark
-        
-        result = speedaf_api.update_order(update_data)
+        result = await api.update_order(update_data)
         
-        return {
+        return ORJSONResponse({
             "success": True,
             "data": result,
             "message": "订单更新成功"
-        }
+        })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ========== 启动配置 ==========
+
+# 未设置 WEB_CONCURRENCY 且读不到容器 CPU 配额时的 worker 数
+DEFAULT_WORKERS = 2
+
+
+def default_workers() -> int:
+    """
+    根据容器的 CPU 配额（cgroup v2/v1）计算 worker 数
+    
+    os.cpu_count() 在容器内返回宿主机核数，不能直接使用；
+    读不到配额（或未限制）时返回 DEFAULT_WORKERS
+    """
+    quota = period = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            q, p = f.read().split()
+        if q != "max":
+            quota, period = int(q), int(p)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                q = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                p = int(f.read())
+            if q > 0:
+                quota, period = q, p
+        except (OSError, ValueError):
+            pass
+    
+    if quota and period:
+        return max(1, -(-quota // period))
+    return DEFAULT_WORKERS
+
+
 #if __name__ == "__main__":
 #    import uvicorn
 #    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -353,4 +428,14 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", 8080))
     print(f"Starting server on port {port}")
     
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # 多 worker 需以 "main:app" 字符串形式传入；uvloop/httptools 由 uvicorn[standard] 提供
+    # worker 数：WEB_CONCURRENCY 优先，否则按容器 CPU 配额
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY") or default_workers()),
+        log_level="warning"
+    )
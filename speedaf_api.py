@@ -4,11 +4,17 @@
 """
 
 import time
-import json
-import requests
-from typing import Dict, Any, Optional, List
+import asyncio
+import httpx
+import orjson
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple
 from tool import triple_des_encrypt, triple_des_decrypt
 
+# 响应密文超过该长度才放到线程池解密；更小的数据直接解密比切换线程更快
+OFFLOAD_DECRYPT_THRESHOLD = 64 * 1024
+
 
 class SpeedAFAPI:
     """速达非API接口类"""
@@ -26,8 +32,60 @@ class SpeedAFAPI:
         self.secret_key = secret_key
         self.base_url = base_url
         self.headers = {'Content-Type': 'text/plain'}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._crypto_pool: Optional[ThreadPoolExecutor] = None
+        # 轨迹查询短期缓存，n8n 常在短时间内重复轮询同一批运单
+        self._track_cache: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+        # 正在进行中的轨迹查询，相同运单号集合的并发请求共享同一次上游调用
+        self._track_inflight: Dict[Tuple[str, ...], asyncio.Future] = {}
+        # 预先拼好各接口的 URL 前缀，请求时只需追加时间戳
+        self._endpoints = {
+            ep: f"{base_url}{ep}?appCode={app_code}&timestamp="
+            for ep in (
+                "/open-api/express/order/createOrder",
+                "/open-api/express/track/query",
+                "/open-api/express/order/cancelOrder",
+                "/open-api/express/order/updateOrder"
+            )
+        }
+    
+    async def aopen(self) -> None:
+        """创建共享的 HTTP 连接池（keep-alive + HTTP/2）及加解密线程池，应在事件循环内调用"""
+        if self._crypto_pool is None:
+            # 仅用于大响应解密；每个 uvicorn worker 各有一个，保持较小的固定大小
+            self._crypto_pool = ThreadPoolExecutor(
+                max_workers=2,
+                thread_name_prefix="speedaf-crypto"
+            )
+        if self._client is None:
+            limits = httpx.Limits(max_keepalive_connections=100, max_connections=200)
+            # 仅对建连失败重试；POST 非幂等，不按 5xx 状态码重试
+            transport = httpx.AsyncHTTPTransport(retries=2, http2=True, limits=limits)
+            # 下单/更新不可重复提交：读超时放宽到 60 秒，避免上游已处理但我们先超时返回 500，
+            # n8n 重试后产生重复订单；建连单独限制为 10 秒（建连失败可安全重试）
+            self._client = httpx.AsyncClient(
+                transport=transport,
+                headers=self.headers,
+                timeout=httpx.Timeout(60.0, connect=10.0)
+            )
+    
+    async def aclose(self) -> None:
+        """关闭 HTTP 连接池及加解密线程池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._crypto_pool is not None:
+            self._crypto_pool.shutdown(wait=False)
+            self._crypto_pool = None
+    
+    async def __aenter__(self):
+        await self.aopen()
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
     
-    def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    async def _make_request(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
         """
         发送API请求的通用方法
         
@@ -38,33 +96,45 @@ class SpeedAFAPI:
         Returns:
             解密后的响应数据
         """
-        timeline = str(int((time.time() + 0.5) * 1000))
+        # 整数运算的毫秒时间戳，保留原有 +0.5 秒的偏移
+        timeline = str((time.time_ns() + 500_000_000) // 1_000_000)
+        
+        if self._client is None:
+            await self.aopen()
         
         # triple_des_encrypt内部会自动添加sign并加密数据
         # sign生成规则: MD5(timeline + secretKey + data)
+        # 请求数据较小，C 实现的加密直接执行比切换线程更快
         encrypted_data = triple_des_encrypt(data, timeline)
         
-        url = f"{self.base_url}{endpoint}?appCode={self.app_code}&timestamp={timeline}"
+        prefix = self._endpoints.get(endpoint)
+        if prefix is None:
+            prefix = f"{self.base_url}{endpoint}?appCode={self.app_code}&timestamp="
+        url = prefix + timeline
         
         try:
-            response = requests.post(url, data=encrypted_data, headers=self.headers)
+            response = await self._client.post(url, content=encrypted_data)
             response.raise_for_status()
             
-            result = response.json()
+            result = orjson.loads(response.content)
             
             if result.get('success') and result.get('data'):
                 # 解密响应数据
-                decrypted_data = triple_des_decrypt(result['data'])
-                return json.loads(decrypted_data.decode())
+                if len(result['data']) > OFFLOAD_DECRYPT_THRESHOLD:
+                    loop = asyncio.get_running_loop()
+                    decrypted_data = await loop.run_in_executor(self._crypto_pool, triple_des_decrypt, result['data'])
+                else:
+                    decrypted_data = triple_des_decrypt(result['data'])
+                return orjson.loads(decrypted_data)
             else:
                 raise Exception(f"API调用失败: {result}")
                 
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             raise Exception(f"网络请求失败: {str(e)}")
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             raise Exception(f"响应数据解析失败: {str(e)}")
     
-    def create_order(self, order_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def create_order(self, order_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         下单接口
         
@@ -102,14 +172,15 @@ class SpeedAFAPI:
             }
         """
         endpoint = "/open-api/express/order/createOrder"
-        return self._make_request(endpoint, order_data)
+        return await self._make_request(endpoint, order_data)
     
-    def query_track(self, mail_no_list: List[str]) -> Dict[str, Any]:
+    async def query_track(self, mail_no_list: List[str], chunk: int = 50) -> Dict[str, Any]:
         """
         轨迹实时查询接口
         
         Args:
             mail_no_list: 运单号列表
+            chunk: 每批运单号数量，超出时分批并发查询
             
         Returns:
             轨迹查询结果
@@ -118,10 +189,88 @@ class SpeedAFAPI:
             mail_no_list = ["47234208672823", "47234208672824"]
         """
         endpoint = "/open-api/express/track/query"
-        data = {"mailNoList": mail_no_list}
-        return self._make_request(endpoint, data)
+        if len(mail_no_list) <= chunk:
+            return await self._make_request(endpoint, {"mailNoList": mail_no_list})
+        
+        # 分批并发请求，总耗时约等于最慢的一批
+        chunks = [mail_no_list[i:i + chunk] for i in range(0, len(mail_no_list), chunk)]
+        results = await asyncio.gather(
+            *[self._make_request(endpoint, {"mailNoList": c}) for c in chunks]
+        )
+        
+        return self._merge_track_results(results)
+    
+    @staticmethod
+    def _merge_track_results(results: List[Any]) -> Any:
+        """
+        合并分批查询的轨迹结果，各批结构必须一致
+        
+        Args:
+            results: 各批次的解密响应
+            
+        Returns:
+            列表结果直接拼接；字典结果拼接 trackList，其余顶层字段保留
+        """
+        if all(isinstance(r, list) for r in results):
+            return [t for r in results for t in r]
+        
+        if all(isinstance(r, dict) and isinstance(r.get("trackList"), list) for r in results):
+            merged: Dict[str, Any] = {}
+            for r in results:
+                merged.update(r)
+            merged["trackList"] = [t for r in results for t in r["trackList"]]
+            return merged
+        
+        raise Exception(f"轨迹分批结果格式不一致，无法合并: {[type(r).__name__ for r in results]}")
+    
+    async def query_track_cached(self, mail_no_list: List[str]) -> Tuple[Dict[str, Any], bool]:
+        """
+        带 30 秒缓存的轨迹查询，相同运单号集合在有效期内直接返回缓存结果；
+        并发的相同查询只向上游发起一次请求，其余等待其结果
+        
+        Args:
+            mail_no_list: 运单号列表
+            
+        Returns:
+            (轨迹查询结果, 是否未请求上游即得到结果)
+        """
+        # 按调用方顺序作为缓存键：缓存结果保留首次查询的顺序，不能给不同顺序的请求复用
+        key = tuple(mail_no_list)
+        while True:
+            result = self._track_cache.get(key)
+            if result is not None:
+                return result, True
+            
+            pending = self._track_inflight.get(key)
+            if pending is None:
+                break
+            try:
+                return await asyncio.shield(pending), True
+            except asyncio.CancelledError:
+                # 发起查询的请求被取消时重新检查缓存并自行查询；自身被取消则继续抛出
+                if not pending.cancelled():
+                    raise
+        
+        future = asyncio.get_running_loop().create_future()
+        self._track_inflight[key] = future
+        try:
+            result = await self.query_track(mail_no_list)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 标记异常已被读取，避免无人等待时打印 "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._track_inflight[key]
+        
+        self._track_cache[key] = result
+        future.set_result(result)
+        return result, False
     
-    def cancel_order(self, customer_code: str, bill_code: str, cancel_reason: str = "customer cancel") -> Dict[str, Any]:
+    async def cancel_order(self, customer_code: str, bill_code: str, cancel_reason: str = "customer cancel") -> Dict[str, Any]:
         """
         取消订单接口
         
@@ -147,9 +296,9 @@ class SpeedAFAPI:
                 "cancelReason": cancel_reason
             }
         ]
-        return self._make_request(endpoint, data)
+        return await self._make_request(endpoint, data)
     
-    def update_order(self, order_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def update_order(self, order_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         更新订单接口
         
@@ -193,7 +342,7 @@ class SpeedAFAPI:
         # 直接传数组，triple_des_encrypt会自动包装成 {"data": "...", "sign": "..."}
         data = [order_data]
         
-        return self._make_request(endpoint, data)
+        return await self._make_request(endpoint, data)
 
 
 class OrderBuilder:
@@ -345,18 +494,121 @@ class OrderBuilder:
         })
         return self
     
-    def build(self) -> Dict[str, Any]:
-        """构建最终的订单数据"""
+    def build(self, copy: bool = True) -> Dict[str, Any]:
+        """
+        构建最终的订单数据
+        
+        Args:
+            copy: 是否返回副本；构建后不再复用 builder 时可传 False 省去一次拷贝
+        """
         # 计算总货物数量
         if "itemList" in self.order_data and self.order_data["itemList"]:
             total_qty = sum(item["goodsQTY"] for item in self.order_data["itemList"])
             self.order_data["goodsQTY"] = total_qty
         
-        return self.order_data.copy()
+        if copy:
+            return self.order_data.copy()
+        return self.order_data
+
+
+def build_order(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    一次性构建下单数据，字段及默认值与 OrderBuilder 一致
+    
+    Args:
+        payload: 下划线命名的订单数据，如 CreateOrderRequest.model_dump(exclude_none=True)
+        
+    Returns:
+        下单接口所需的订单数据
+    """
+    sender = payload["sender"]
+    receiver = payload["receiver"]
+    parcel = payload["parcel"]
+    items = payload["items"]
+    service = payload.get("service") or {}
+    
+    order_data = {
+        "customOrderNo": payload["custom_order_no"],
+        "customerCode": payload["customer_code"],
+        "sendName": sender["name"],
+        "sendMobile": sender["mobile"],
+        "sendAddress": sender["address"],
+        "sendCountryCode": sender.get("country_code", "CN"),
+        "sendCompanyName": sender.get("company_name", ""),
+        "sendPhone": sender.get("phone", ""),
+        "sendMail": sender.get("email", ""),
+        "sendProvinceCode": "",
+        "sendProvinceName": "",
+        "sendCityCode": "",
+        "sendCityName": "",
+        "sendDistrictCode": "",
+        "sendDistrictName": "",
+        "sendPostCode": "",
+        "acceptName": receiver["name"],
+        "acceptMobile": receiver["mobile"],
+        "acceptAddress": receiver["address"],
+        "acceptCountryCode": receiver["country_code"],
+        "acceptCompanyName": receiver.get("company_name", ""),
+        "acceptPhone": receiver.get("phone", ""),
+        "acceptEmail": receiver.get("email", ""),
+        "acceptProvinceCode": "",
+        "acceptProvinceName": "",
+        "acceptCityCode": "",
+        "acceptCityName": "",
+        "acceptDistrictCode": "",
+        "acceptDistrictName": "",
+        "acceptPostCode": "",
+        "parcelWeight": parcel["weight"],
+        "piece": parcel.get("piece", 1),
+        "itemList": [
+            {
+                "goodsName": item["goods_name"],
+                "goodsNameDialect": item.get("goods_name_dialect") or item["goods_name"],
+                "goodsQTY": item["goods_qty"],
+                "goodsValue": item["goods_value"],
+                "goodsWeight": item["goods_weight"],
+                "goodsType": item.get("goods_type", "IT02"),
+                "battery": 0,
+                "blInsure": 0,
+                "dutyMoney": 0,
+                "goodsId": "",
+                "sku": item.get("sku", ""),
+                "goodsMaterial": "",
+                "goodsRemark": "",
+                "goodsRule": "",
+                "goodsUnitPrice": 0,
+                "makeCountry": "",
+                "salePath": "",
+                "unit": ""
+            }
+            for item in items
+        ],
+        "deliveryType": service.get("delivery_type", "DE01"),
+        "payMethod": service.get("pay_method", "PA01"),
+        "parcelType": service.get("parcel_type", "PT01"),
+        "shipType": "ST01",
+        "transportType": "TT01",
+        "platformSource": "TEST22",
+        "codFee": 0,
+        "insurePrice": 0,
+        "shippingFee": 0,
+        "remark": service.get("remark", "")
+    }
+    
+    # 可选的包裹尺寸，仅在提供时写入
+    for key, field in (("volume", "parcelVolume"), ("length", "parcelLength"),
+                       ("width", "parcelWidth"), ("height", "parcelHigh")):
+        if parcel.get(key) is not None:
+            order_data[field] = parcel[key]
+    
+    if items:
+        order_data["goodsQTY"] = sum(item["goods_qty"] for item in items)
+    
+    return order_data
 
 
 # 使用示例和测试代码
-if __name__ == "__main__":
+async def _demo():
     # 初始化API客户端
     api = SpeedAFAPI(
         app_code="11111111",
@@ -388,12 +640,14 @@ if __name__ == "__main__":
                  goods_weight=1.45
              )
              .set_service_options()
-             .build())
+             .build(copy=False))
     
     try:
+        await api.aopen()
+        
         # 测试下单接口
         print("测试下单接口...")
-        result = api.create_order(order)
+        result = await api.create_order(order)
         print("下单成功:", result)
         
         # 如果下单成功，测试其他接口
@@ -403,12 +657,12 @@ if __name__ == "__main__":
             
             # 测试轨迹查询
             print("\n测试轨迹查询接口...")
-            track_result = api.query_track([bill_code])
+            track_result = await api.query_track([bill_code])
             print("轨迹查询结果:", track_result)
             
             # 测试取消订单
             print("\n测试取消订单接口...")
-            cancel_result = api.cancel_order("MA000027", bill_code, "customer cancel")
+            cancel_result = await api.cancel_order("MA000027", bill_code, "customer cancel")
             print("取消订单结果:", cancel_result)
             
             # 测试更新订单
@@ -419,8 +673,14 @@ if __name__ == "__main__":
             update_order_data["acceptName"] = "Updated Name"
             update_order_data["remark"] = "订单已更新"
             
-            update_result = api.update_order(update_order_data)
+            update_result = await api.update_order(update_order_data)
             print("更新订单结果:", update_result)
             
     except Exception as e:
-        print(f"测试失败: {str(e)}")
\ No newline at end of file
+        print(f"测试失败: {str(e)}")
+    finally:
+        await api.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(_demo())
@@ -0,0 +1,208 @@
+"""
+speedaf_api 单元测试
+"""
+
+import asyncio
+
+import pytest
+
+from speedaf_api import OrderBuilder, SpeedAFAPI, build_order
+
+
+def _payload():
+    """与 CreateOrderRequest.model_dump(exclude_none=True) 结构一致的订单数据"""
+    return {
+        "custom_order_no": "TEST001",
+        "customer_code": "MA000027",
+        "sender": {
+            "name": "张三",
+            "mobile": "13800138000",
+            "address": "北京市朝阳区测试地址",
+            "country_code": "CN",
+            "company_name": "测试公司",
+            "phone": "010-1234567"
+        },
+        "receiver": {
+            "name": "John Doe",
+            "mobile": "1778922222",
+            "address": "Lagos Test Address",
+            "country_code": "NG",
+            "company_name": "",
+            "phone": "",
+            "email": "john@example.com"
+        },
+        "parcel": {"weight": 2.54, "volume": 1.52, "length": 10, "height": 5, "piece": 2},
+        "items": [
+            {"goods_name": "测试商品", "goods_qty": 2, "goods_value": 190, "goods_weight": 1.45,
+             "goods_name_dialect": "", "goods_type": "IT02", "sku": ""},
+            {"goods_name": "手机", "goods_qty": 3, "goods_value": 50, "goods_weight": 0.3,
+             "goods_name_dialect": "phone", "goods_type": "IT01", "sku": "SKU-1"}
+        ],
+        "service": {"delivery_type": "DE02", "pay_method": "PA02", "parcel_type": "PT02", "remark": "易碎"}
+    }
+
+
+def _build_with_builder(payload, sender_email=""):
+    """按原 main.create_order 的方式用 OrderBuilder 构建订单"""
+    sender, receiver, parcel = payload["sender"], payload["receiver"], payload["parcel"]
+    builder = (OrderBuilder()
+               .set_custom_order_no(payload["custom_order_no"])
+               .set_customer_code(payload["customer_code"])
+               .set_sender(name=sender["name"], mobile=sender["mobile"], address=sender["address"],
+                           country_code=sender["country_code"], company_name=sender["company_name"],
+                           phone=sender["phone"], email=sender_email)
+               .set_receiver(name=receiver["name"], mobile=receiver["mobile"], address=receiver["address"],
+                             country_code=receiver["country_code"], company_name=receiver["company_name"],
+                             phone=receiver["phone"], email=receiver["email"])
+               .set_parcel_info(weight=parcel["weight"], volume=parcel.get("volume"),
+                                length=parcel.get("length"), width=parcel.get("width"),
+                                height=parcel.get("height"), piece=parcel["piece"]))
+    for item in payload["items"]:
+        builder.add_item(goods_name=item["goods_name"], goods_qty=item["goods_qty"],
+                         goods_value=item["goods_value"], goods_weight=item["goods_weight"],
+                         goods_name_dialect=item["goods_name_dialect"], goods_type=item["goods_type"],
+                         sku=item["sku"])
+    service = payload.get("service")
+    if service:
+        builder.set_service_options(delivery_type=service["delivery_type"], pay_method=service["pay_method"],
+                                    parcel_type=service["parcel_type"], remark=service["remark"])
+    else:
+        builder.set_service_options()
+    return builder.build()
+
+
+def test_build_order_matches_order_builder():
+    """build_order 与 OrderBuilder 构建的订单完全一致（缺省的 email 为 ""）"""
+    payload = _payload()
+    assert build_order(payload) == _build_with_builder(payload)
+
+
+def test_build_order_explicit_null_becomes_empty_string():
+    """显式传 null 的可选字段被 exclude_none 去掉，由 build_order 补为 ""，这是唯一的差异"""
+    payload = _payload()
+    expected = _build_with_builder(payload, sender_email=None)
+    actual = build_order(payload)
+    assert expected["sendMail"] is None
+    assert actual["sendMail"] == ""
+    expected["sendMail"] = ""
+    assert actual == expected
+
+
+def test_build_order_without_service_uses_builder_defaults():
+    """未提供服务选项时使用与 OrderBuilder 相同的默认值"""
+    payload = _payload()
+    del payload["service"]
+    assert build_order(payload) == _build_with_builder(payload)
+
+
+def test_merge_track_results_concatenates_lists():
+    """各批均为列表时直接拼接"""
+    assert SpeedAFAPI._merge_track_results([[1, 2], [3], []]) == [1, 2, 3]
+
+
+def test_merge_track_results_merges_dicts_and_keeps_other_fields():
+    """各批均为带 trackList 的字典时拼接 trackList，其余顶层字段保留"""
+    results = [
+        {"ok": 1, "trackList": [{"mailNo": "1"}]},
+        {"ok": 1, "extra": "x", "trackList": [{"mailNo": "2"}, {"mailNo": "3"}]}
+    ]
+    assert SpeedAFAPI._merge_track_results(results) == {
+        "ok": 1,
+        "extra": "x",
+        "trackList": [{"mailNo": "1"}, {"mailNo": "2"}, {"mailNo": "3"}]
+    }
+
+
+@pytest.mark.parametrize("results", [
+    [[{"mailNo": "1"}], {"trackList": [{"mailNo": "2"}]}],
+    [{"trackList": []}, {"other": []}],
+    [{"other": [1]}, {"other": [2]}],
+    [{"trackList": "not a list"}, {"trackList": []}]
+])
+def test_merge_track_results_rejects_inconsistent_batches(results):
+    """各批结构不一致或缺少 trackList 时报错，而不是静默丢数据"""
+    with pytest.raises(Exception, match="格式不一致"):
+        SpeedAFAPI._merge_track_results(results)
+
+
+def _track_api(delay=0.0, error=None):
+    """返回一个 SpeedAFAPI，其 query_track 由计数的假上游替代"""
+    api = SpeedAFAPI(app_code="11111111", secret_key="uYMGr8eU")
+    api.calls = []
+    
+    async def fake_query_track(mail_no_list):
+        api.calls.append(list(mail_no_list))
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return {"trackList": [{"mailNo": no} for no in mail_no_list]}
+    
+    api.query_track = fake_query_track
+    return api
+
+
+def test_query_track_cached_key_respects_order():
+    """缓存键区分运单号顺序：不同顺序的请求不命中，结果始终按调用方顺序返回"""
+    api = _track_api()
+    
+    async def run():
+        first = await api.query_track_cached(["1", "2"])
+        again = await api.query_track_cached(["1", "2"])
+        reversed_ = await api.query_track_cached(["2", "1"])
+        return first, again, reversed_
+    
+    (first, first_hit), (again, again_hit), (reversed_, reversed_hit) = asyncio.run(run())
+    assert (first_hit, again_hit, reversed_hit) == (False, True, False)
+    assert again is first
+    assert [t["mailNo"] for t in reversed_["trackList"]] == ["2", "1"]
+    assert api.calls == [["1", "2"], ["2", "1"]]
+
+
+def test_query_track_cached_coalesces_concurrent_calls():
+    """20 个并发的相同查询只请求上游一次，其余作为命中返回同一结果"""
+    api = _track_api(delay=0.05)
+    
+    async def run():
+        return await asyncio.gather(*[api.query_track_cached(["1", "2"]) for _ in range(20)])
+    
+    results = asyncio.run(run())
+    assert len(api.calls) == 1
+    assert sum(hit for _, hit in results) == 19
+    assert all(result is results[0][0] for result, _ in results)
+    assert api._track_inflight == {}
+
+
+def test_query_track_cached_error_reaches_every_waiter():
+    """上游出错时所有等待者都收到该异常，且进行中的记录被清理、结果不被缓存"""
+    api = _track_api(delay=0.05, error=Exception("boom"))
+    
+    async def run():
+        return await asyncio.gather(*[api.query_track_cached(["1"]) for _ in range(5)],
+                                    return_exceptions=True)
+    
+    results = asyncio.run(run())
+    assert len(api.calls) == 1
+    assert [str(r) for r in results] == ["boom"] * 5
+    assert api._track_inflight == {}
+    assert len(api._track_cache) == 0
+
+
+def test_query_track_cached_waiter_retries_after_leader_cancelled():
+    """发起查询的请求被取消后，等待者自行查询上游而不是随之失败"""
+    api = _track_api(delay=0.05)
+    
+    async def run():
+        leader = asyncio.create_task(api.query_track_cached(["1"]))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(api.query_track_cached(["1"]))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+    
+    result, hit = asyncio.run(run())
+    assert hit is False
+    assert result == {"trackList": [{"mailNo": "1"}]}
+    assert api.calls == [["1"], ["1"]]
+    assert api._track_inflight == {}
@@ -3,88 +3,58 @@ import configparser
 from asyncio.log import logger
 from base64 import b64encode, b64decode
 from hashlib import md5
-from pyDes import des, CBC, PAD_PKCS5
+from functools import partial
+from Crypto.Cipher import DES
+from Crypto.Util.Padding import pad, unpad
 import json
 
 appCode = "11111111"
 secretKey = b"uYMGr8eU"
 
+IV = bytes([0x12, 0x34, 0x56, 0x78, 0x90, 0xAB, 0xCD, 0xEF])
+
+# DES-CBC 工厂（pycryptodome，C 实现）；CBC 对象有状态，每次加解密新建一个
+new_cipher = partial(DES.new, secretKey, DES.MODE_CBC, iv=IV)
+
 
 
 #des加密
 def triple_des_encrypt(data, timeline):
-    signature = generate_signature(data, timeline)
+    # 只序列化一次，签名与发送使用同一份数据
+    # 保持 stdlib json（非 ASCII 转义为 \uXXXX），与速达非验签一致
+    dataToSend = json.dumps(data, separators=(",", ":"))
+    signature = generate_signature(dataToSend.encode("utf-8"), timeline)
     #print('Signature:', signature)
 
-    dataToSend = json.dumps(data, separators=(",", ":"))
     message = {"data": dataToSend, "sign": signature}
 
 
-    pson = json.dumps(message, separators=(",", ":"))
-    # pson = str(message)
-    data = bytes(pson, "utf-8")
-    
-    IV = bytearray()
-    IV.append(0x12)
-    IV.append(0x34)
-    IV.append(0x56)
-    IV.append(0x78)
-    IV.append(0x90)
-    IV.append(0xAB)
-    IV.append(0xCD)
-    IV.append(0xEF)
-
-    k = des(
-        secretKey,
-        CBC,
-        IV,
-        pad=None,
-        padmode=PAD_PKCS5
-    )
-    d = k.encrypt(data)
-    return b64encode(d).decode("utf-8")
+    data = json.dumps(message, separators=(",", ":")).encode("utf-8")
+
+    d = new_cipher().encrypt(pad(data, DES.block_size))
+    # 直接返回 base64 bytes，作为请求体发送时无需再编码
+    return b64encode(d)
 
 #des解密
 def triple_des_decrypt(message):
-    pson = json.dumps(message, separators=(",", ":"))
-    # pson = str(message)
-    data = bytes(pson, "utf-8")
-
-    IV = bytearray()
-    IV.append(0x12)
-    IV.append(0x34)
-    IV.append(0x56)
-    IV.append(0x78)
-    IV.append(0x90)
-    IV.append(0xAB)
-    IV.append(0xCD)
-    IV.append(0xEF)
-
-    k = des(
-        secretKey,
-        CBC,
-        IV,
-        pad=None,
-        padmode=PAD_PKCS5
-    )
-    aa = b64decode(data)
-    d = k.decrypt(aa, padmode=PAD_PKCS5)
-   
+    aa = b64decode(message)
+    d = unpad(new_cipher().decrypt(aa), DES.block_size)
 
     return d
 
 
-def generate_signature(message, timeline):
-    secretKey = "uYMGr8eU"
-    logger.info(f"timeline: {timeline}")
-    logger.info(f"secretKey: {secretKey}")
-    logger.info(f"message: {message}")
-    dumped_message = json.dumps(message, separators=(",", ":"))
-    key_before_hashing = timeline + secretKey + dumped_message
-    key_before_hashing = bytes(key_before_hashing, "utf-8")
-    logger.info(f"before md5: {key_before_hashing}")
-    sig = md5(key_before_hashing).hexdigest()
-    logger.info(f"Signature: {sig}")
+def generate_signature(dumped_message, timeline):
+    # dumped_message 为已序列化的 JSON bytes
+    # sign = MD5(timeline + secretKey + data)，timeline 在最前，无法预先缓存 secretKey 的哈希状态；
+    # 直接分段 update，省去拼接整段字符串
+    logger.info("timeline: %s", timeline)
+    logger.info("secretKey: %s", secretKey)
+    logger.info("message: %s", dumped_message)
+    h = md5(timeline.encode())
+    h.update(secretKey)
+    h.update(dumped_message)
+    sig = h.hexdigest()
+    logger.info("Signature: %s", sig)
     return sig
         
 